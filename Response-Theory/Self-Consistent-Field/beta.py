@@ -21,6 +21,17 @@ np.set_printoptions(precision=5, linewidth=200, suppress=True)
 import psi4
 from helper_CPHF import helper_CPHF
 
+
+def trace_occ_pre(AB, C, nocc):
+    """Return tr[(AB C)_{occ,occ}] for a precomputed product AB."""
+    return np.einsum('pq,qp->', AB[:nocc], C[:, :nocc])
+
+
+def trace_occ(A, B, C, nocc):
+    """Return tr[(A B C)_{occ,occ}] without forming the full product."""
+    return trace_occ_pre(A[:nocc].dot(B), C, nocc)
+
+
 # Memory for Psi4 in GB
 psi4.set_memory('2 GB')
 psi4.core.set_output_file("output.dat", False)
@@ -58,59 +69,72 @@ nvir = norb - nocc
 nov = nocc * nvir
 x = np.asarray(helper.x)
 ncomp = x.shape[0]
-integrals_ao = np.asarray([np.asarray(dipole_ao_component)
-                           for dipole_ao_component in helper.tmp_dipoles])
+integrals_ao = helper.dipoles_ao
 
-# form full MO-basis dipole integrals
-integrals_mo = np.empty(shape=(ncomp, norb, norb))
-for i in range(ncomp):
-    integrals_mo[i] = (C.T).dot(integrals_ao[i]).dot(C)
+# form full MO-basis dipole integrals; transform all components at once
+integrals_mo = np.tensordot(integrals_ao, C, axes=([2], [0]))
+integrals_mo = np.ascontiguousarray(
+    np.tensordot(C, integrals_mo, axes=([0], [1])).transpose(1, 0, 2))
 
 # repack response vectors to [norb, norb]; 1/2 is due to X + Y
 U = np.zeros_like(integrals_mo)
-for i in range(ncomp):
-    U[i, :nocc, nocc:] = 0.5 * x[i].reshape(nocc, nvir)
-    U[i, nocc:, :nocc] = -0.5 * x[i].reshape(nocc, nvir).T
+U[:, :nocc, nocc:] = 0.5 * x.reshape(ncomp, nocc, nvir)
+U[:, nocc:, :nocc] = -0.5 * x.reshape(ncomp, nocc, nvir).transpose(0, 2, 1)
 
 # form G matrices from perturbation and generalized Fock matrices; do
-# one more Fock build for each response vector
+# one more Fock build for each response vector, all components at once
 jk = psi4.core.JK.build(helper.scf_wfn.basisset())
 jk.initialize()
 G = np.empty_like(U)
-R = psi4.core.Matrix(nbf, nocc)
-npR = np.asarray(R)
-for i in range(ncomp):
-    V = integrals_mo[i]
 
-    # eqn. (III-1b) Note: this simplified handling of the response
-    # vector transformation for the Fock build is insufficient for
-    # frequency-dependent response.
-    jk.C_clear()
-    # Psi4's JK builders don't take a density, but a left set of
-    # coefficients with shape [nbf, nocc] and a right set of
-    # coefficents with shape [nbf, nocc]. Because the response vector
-    # describes occ -> vir transitions, we perform ([nocc, nvir] *
-    # [nbf, nvir]^T)^T.
+# eqn. (III-1b) Note: this simplified handling of the response vector
+# transformation for the Fock build is insufficient for
+# frequency-dependent response.
+# Psi4's JK builders don't take a density, but a left set of
+# coefficients with shape [nbf, nocc] and a right set of coefficents
+# with shape [nbf, nocc]. Because the response vector describes occ ->
+# vir transitions, we perform [nbf, nvir] * [nocc, nvir]^T.
+jk.C_clear()
+R = []
+nCv = np.asarray(Cv)
+for i in range(ncomp):
     L = Co
-    npR[:] = x[i].reshape(nocc, nvir).dot(np.asarray(Cv).T).T
+    R.append(psi4.core.Matrix(nbf, nocc))
+    npR = np.asarray(R[i])
+    npR[:] = nCv.dot(x[i].reshape(nocc, nvir).T)
     jk.C_left_add(L)
-    jk.C_right_add(R)
-    jk.compute()
-    # 1/2 is due to X + Y
-    J = 0.5 * np.asarray(jk.J()[0])
-    K = 0.5 * np.asarray(jk.K()[0])
+    jk.C_right_add(R[i])
+jk.compute()
+
+# Fortran-ordered copy so that C^T is C-contiguous for the MO transforms
+C_f = np.asfortranarray(C)
+CT = C_f.T
+# 1/2 is due to X + Y; fold it into the left MO coefficients once
+CT_half = 0.5 * CT
+# Scratch buffer for 4J - K - K^T
+G_ao = np.empty((nbf, nbf))
+for i in range(ncomp):
+    V = integrals_mo[i]
+
+    J = np.asarray(jk.J()[i])
+    K = np.asarray(jk.K()[i])
 
     # eqn. (21b)
-    F = (C.T).dot(4 * J - K.T - K).dot(C)
+    np.multiply(4.0, J, out=G_ao)
+    G_ao -= K
+    G_ao -= K.T
+    F = np.linalg.multi_dot([CT_half, G_ao, C])
     G[i] = V + F
 
 # form epsilon matrices, eqn. (34)
-E = G.copy()
 omega = 0
-for i in range(ncomp):
-    eoU = (moenergies[..., na] + omega) * U[i]
-    Ue = U[i] * moenergies[na]
-    E[i] += (eoU - Ue)
+E = G + (moenergies[na, :, na] + omega) * U - U * moenergies[na, na, :]
+
+# Every trace below is of the form tr[(U_x M_y Z_z)_occ,occ]; form the
+# occupied rows of all pairwise products U_x G_y and U_x U_y once, so
+# that each term only contracts them with the occupied columns of Z.
+UG = np.tensordot(U[:, :nocc], G, axes=([2], [1])).transpose(0, 2, 1, 3)
+UU = np.tensordot(U[:, :nocc], U, axes=([2], [1])).transpose(0, 2, 1, 3)
 
 # Assume some symmetry and calculate only part of the tensor.
 # eqn. (VII-4)
@@ -121,15 +145,15 @@ for r in range(6):
     b = off1[r]
     c = off2[r]
     for a in range(3):
-        tl1 = 2 * np.trace(U[a].dot(G[b]).dot(U[c])[:nocc, :nocc])
-        tl2 = 2 * np.trace(U[a].dot(G[c]).dot(U[b])[:nocc, :nocc])
-        tl3 = 2 * np.trace(U[c].dot(G[a]).dot(U[b])[:nocc, :nocc])
-        tr1 = np.trace(U[c].dot(U[b]).dot(E[a])[:nocc, :nocc])
-        tr2 = np.trace(U[b].dot(U[c]).dot(E[a])[:nocc, :nocc])
-        tr3 = np.trace(U[c].dot(U[a]).dot(E[b])[:nocc, :nocc])
-        tr4 = np.trace(U[a].dot(U[c]).dot(E[b])[:nocc, :nocc])
-        tr5 = np.trace(U[b].dot(U[a]).dot(E[c])[:nocc, :nocc])
-        tr6 = np.trace(U[a].dot(U[b]).dot(E[c])[:nocc, :nocc])
+        tl1 = 2 * trace_occ_pre(UG[a, b], U[c], nocc)
+        tl2 = 2 * trace_occ_pre(UG[a, c], U[b], nocc)
+        tl3 = 2 * trace_occ_pre(UG[c, a], U[b], nocc)
+        tr1 = trace_occ_pre(UU[c, b], E[a], nocc)
+        tr2 = trace_occ_pre(UU[b, c], E[a], nocc)
+        tr3 = trace_occ_pre(UU[c, a], E[b], nocc)
+        tr4 = trace_occ_pre(UU[a, c], E[b], nocc)
+        tr5 = trace_occ_pre(UU[b, a], E[c], nocc)
+        tr6 = trace_occ_pre(UU[a, b], E[c], nocc)
         tl = tl1 + tl2 + tl3
         tr = tr1 + tr2 + tr3 + tr4 + tr5 + tr6
         hyperpolarizability[r, a] = -2 * (tl - tr)
@@ -170,17 +194,16 @@ helper2.solve_dynamic_direct(omega=f2)
 helper2.form_polarizability()
 print(helper2.polar)
 
-rspvecs1 = helper1.x
-rspvecs2 = helper2.x
+rspvecs1 = np.asarray(helper1.x)
+rspvecs2 = np.asarray(helper2.x)
 
 # repack response vectors to [norb, norb]
 U1 = np.zeros_like(integrals_mo)
 U2 = np.zeros_like(integrals_mo)
-for i in range(ncomp):
-    U1[i, :nocc, nocc:] = rspvecs1[i][nov:].reshape(nocc, nvir)
-    U1[i, nocc:, :nocc] = rspvecs1[i][:nov].reshape(nocc, nvir).T
-    U2[i, :nocc, nocc:] = rspvecs2[i][nov:].reshape(nocc, nvir)
-    U2[i, nocc:, :nocc] = rspvecs2[i][:nov].reshape(nocc, nvir).T
+U1[:, :nocc, nocc:] = rspvecs1[:, nov:].reshape(ncomp, nocc, nvir)
+U1[:, nocc:, :nocc] = rspvecs1[:, :nov].reshape(ncomp, nocc, nvir).transpose(0, 2, 1)
+U2[:, :nocc, nocc:] = rspvecs2[:, nov:].reshape(ncomp, nocc, nvir)
+U2[:, nocc:, :nocc] = rspvecs2[:, :nov].reshape(ncomp, nocc, nvir).transpose(0, 2, 1)
 
 G1 = np.empty_like(U1)
 G2 = np.empty_like(U2)
@@ -231,21 +254,14 @@ for i in range(3):
     K1 = K1_l + K1_r.T
     K2 = K2_l + K2_r.T
 
-    F1 = (C.T).dot(2 * J1 - K1).dot(C)
-    F2 = (C.T).dot(2 * J2 - K2).dot(C)
+    F1 = np.linalg.multi_dot([CT, 2 * J1 - K1, C])
+    F2 = np.linalg.multi_dot([CT, 2 * J2 - K2, C])
     G1[i, ...] = V + F1
     G2[i, ...] = V + F2
 
 # form epsilon matrices, eqn. (34), one for each frequency
-E1 = G1.copy()
-E2 = G2.copy()
-for i in range(ncomp):
-    eoU1 = (moenergies[..., na] + f1) * U1[i]
-    Ue1 = U1[i] * moenergies[na]
-    E1[i] += (eoU1 - Ue1)
-    eoU2 = (moenergies[..., na] + f2) * U2[i]
-    Ue2 = U2[i] * moenergies[na]
-    E2[i] += (eoU2 - Ue2)
+E1 = G1 + (moenergies[na, :, na] + f1) * U1 - U1 * moenergies[na, na, :]
+E2 = G2 + (moenergies[na, :, na] + f2) * U2 - U2 * moenergies[na, na, :]
 
 # Assume some symmetry and calculate only part of the tensor.
 
@@ -254,18 +270,18 @@ for r in range(6):
     b = off1[r]
     c = off2[r]
     for a in range(3):
-        tl1 = np.trace(U2[a].T.dot(G1[b]).dot(U1[c])[:nocc, :nocc])
-        tl2 = np.trace(U1[c].dot(G1[b]).dot(U2[a].T)[:nocc, :nocc])
-        tl3 = np.trace(U2[a].T.dot(G1[c]).dot(U1[b])[:nocc, :nocc])
-        tl4 = np.trace(U1[b].dot(G1[c]).dot(U2[a].T)[:nocc, :nocc])
-        tl5 = np.trace(U1[c].dot(-G2[a].T).dot(U1[b])[:nocc, :nocc])
-        tl6 = np.trace(U1[b].dot(-G2[a].T).dot(U1[c])[:nocc, :nocc])
-        tr1 = np.trace(U1[c].dot(U1[b]).dot(-E2[a].T)[:nocc, :nocc])
-        tr2 = np.trace(U1[b].dot(U1[c]).dot(-E2[a].T)[:nocc, :nocc])
-        tr3 = np.trace(U1[c].dot(U2[a].T).dot(E1[b])[:nocc, :nocc])
-        tr4 = np.trace(U2[a].T.dot(U1[c]).dot(E1[b])[:nocc, :nocc])
-        tr5 = np.trace(U1[b].dot(U2[a].T).dot(E1[c])[:nocc, :nocc])
-        tr6 = np.trace(U2[a].T.dot(U1[b]).dot(E1[c])[:nocc, :nocc])
+        tl1 = trace_occ(U2[a].T, G1[b], U1[c], nocc)
+        tl2 = trace_occ(U1[c], G1[b], U2[a].T, nocc)
+        tl3 = trace_occ(U2[a].T, G1[c], U1[b], nocc)
+        tl4 = trace_occ(U1[b], G1[c], U2[a].T, nocc)
+        tl5 = trace_occ(U1[c], -G2[a].T, U1[b], nocc)
+        tl6 = trace_occ(U1[b], -G2[a].T, U1[c], nocc)
+        tr1 = trace_occ(U1[c], U1[b], -E2[a].T, nocc)
+        tr2 = trace_occ(U1[b], U1[c], -E2[a].T, nocc)
+        tr3 = trace_occ(U1[c], U2[a].T, E1[b], nocc)
+        tr4 = trace_occ(U2[a].T, U1[c], E1[b], nocc)
+        tr5 = trace_occ(U1[b], U2[a].T, E1[c], nocc)
+        tr6 = trace_occ(U2[a].T, U1[b], E1[c], nocc)
         tl = tl1 + tl2 + tl3 + tl4 + tl5 + tl6
         tr = tr1 + tr2 + tr3 + tr4 + tr5 + tr6
         hyperpolarizability[r, a] = 2 * (tl - tr)
@@ -312,18 +328,18 @@ for r in range(6):
     b = off1[r]
     c = off2[r]
     for a in range(3):
-        tl1 = np.trace(mU[0][a].dot(mG[1][b]).dot(mU[1][c])[:nocc, :nocc])
-        tl2 = np.trace(mU[1][c].dot(mG[1][b]).dot(mU[0][a])[:nocc, :nocc])
-        tl3 = np.trace(mU[0][a].dot(mG[1][c]).dot(mU[1][b])[:nocc, :nocc])
-        tl4 = np.trace(mU[1][b].dot(mG[1][c]).dot(mU[0][a])[:nocc, :nocc])
-        tl5 = np.trace(mU[1][c].dot(mG[0][a]).dot(mU[1][b])[:nocc, :nocc])
-        tl6 = np.trace(mU[1][b].dot(mG[0][a]).dot(mU[1][c])[:nocc, :nocc])
-        tr1 = np.trace(mU[1][c].dot(mU[1][b]).dot(me[0][a])[:nocc, :nocc])
-        tr2 = np.trace(mU[1][b].dot(mU[1][c]).dot(me[0][a])[:nocc, :nocc])
-        tr3 = np.trace(mU[1][c].dot(mU[0][a]).dot(me[1][b])[:nocc, :nocc])
-        tr4 = np.trace(mU[0][a].dot(mU[1][c]).dot(me[1][b])[:nocc, :nocc])
-        tr5 = np.trace(mU[1][b].dot(mU[0][a]).dot(me[1][c])[:nocc, :nocc])
-        tr6 = np.trace(mU[0][a].dot(mU[1][b]).dot(me[1][c])[:nocc, :nocc])
+        tl1 = trace_occ(mU[0][a], mG[1][b], mU[1][c], nocc)
+        tl2 = trace_occ(mU[1][c], mG[1][b], mU[0][a], nocc)
+        tl3 = trace_occ(mU[0][a], mG[1][c], mU[1][b], nocc)
+        tl4 = trace_occ(mU[1][b], mG[1][c], mU[0][a], nocc)
+        tl5 = trace_occ(mU[1][c], mG[0][a], mU[1][b], nocc)
+        tl6 = trace_occ(mU[1][b], mG[0][a], mU[1][c], nocc)
+        tr1 = trace_occ(mU[1][c], mU[1][b], me[0][a], nocc)
+        tr2 = trace_occ(mU[1][b], mU[1][c], me[0][a], nocc)
+        tr3 = trace_occ(mU[1][c], mU[0][a], me[1][b], nocc)
+        tr4 = trace_occ(mU[0][a], mU[1][c], me[1][b], nocc)
+        tr5 = trace_occ(mU[1][b], mU[0][a], me[1][c], nocc)
+        tr6 = trace_occ(mU[0][a], mU[1][b], me[1][c], nocc)
         tl = [tl1, tl2, tl3, tl4, tl5, tl6]
         tr = [tr1, tr2, tr3, tr4, tr5, tr6]
         hyperpolarizability[r, a] = 2 * (sum(tl) - sum(tr))
@@ -342,11 +358,9 @@ for ip, p in enumerate(list(product(range(3), range(3), range(3)))):
     # 2nd tuple -> index frequency (0 -> -2w, 1 -> +w)
     for iq, q in enumerate(list(permutations(zip(p, (0, 1, 1)), 3))):
         d, e, f = q
-        tlp = (mU[d[1]][d[0]]).dot(mG[e[1]][e[0]]).dot(mU[f[1]][f[0]])
-        tle = np.trace(tlp[:nocc, :nocc])
+        tle = trace_occ(mU[d[1]][d[0]], mG[e[1]][e[0]], mU[f[1]][f[0]], nocc)
         tl.append(tle)
-        trp = (mU[d[1]][d[0]]).dot(mU[e[1]][e[0]]).dot(me[f[1]][f[0]])
-        tre = np.trace(trp[:nocc, :nocc])
+        tre = trace_occ(mU[d[1]][d[0]], mU[e[1]][e[0]], me[f[1]][f[0]], nocc)
         tr.append(tre)
     hyperpolarizability_full[a, b, c] = 2 * (sum(tl) - sum(tr))
 print('hyperpolarizability: SHG, (-{}; {}, {}), full tensor'.format(f2, f1, f1))
@@ -12,15 +12,26 @@ __date__      = "2017-8-30"
 
 import time
 import numpy as np
-np.set_printoptions(precision=5, linewidth=200, suppress=True)
 import psi4
+from scipy.linalg import lu_factor, lu_solve
+from scipy.sparse.linalg import LinearOperator, gmres
 
+import inspect
 import os.path
 import sys
 dirname = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(dirname, '../../Self-Consistent-Field'))
 from helper_HF import DIIS_helper
 
+# SciPy 1.12 renamed gmres' `tol` to `rtol`, while `atol` and
+# `callback_type` only exist from SciPy 1.1 onwards; older versions
+# already use a purely relative tolerance and report the preconditioned
+# residual norm to the callback.
+try:
+    _gmres_args = inspect.signature(gmres).parameters
+except AttributeError:
+    _gmres_args = inspect.getargspec(gmres).args
+
 
 class helper_CPHF(object):
 
@@ -52,12 +63,11 @@ class helper_CPHF(object):
         nCo = np.asarray(self.Co)
         nCv = np.asarray(self.Cv)
         self.tmp_dipoles = self.mints.so_dipole()
-        self.dipoles_xyz = []
+        nao = nCo.shape[0]
+        self.dipoles_ao = np.empty((3, nao, nao))
         for num in range(3):
-            Fso = np.asarray(self.tmp_dipoles[num])
-            Fia = (nCo.T).dot(Fso).dot(nCv)
-            Fia *= -2
-            self.dipoles_xyz.append(Fia)
+            np.copyto(self.dipoles_ao[num], np.asarray(self.tmp_dipoles[num]))
+        self.dipoles_xyz = -2 * np.einsum('pi,xpq,qa->xia', nCo, self.dipoles_ao, nCv, optimize=True)
 
         self.x = None
         self.rhsvecs = None
@@ -74,18 +84,30 @@ class helper_CPHF(object):
                 self.solve_static_iterative()
             else:
                 self.solve_dynamic_iterative(omega=omega)
+        elif self.method == 'krylov':
+            if not omega:
+                self.solve_static_krylov()
+            else:
+                raise Exception("Method %s is only available for static response" % self.method)
         else:
             raise Exception("Method %s is not recognized" % self.method)
         self.form_polarizability()
 
+    def _orbital_energy_hessian(self):
+        # Orbital energy differences only live on the iaia diagonal
+        H = np.zeros((self.nocc, self.nvir, self.nocc, self.nvir))
+        idx_o = np.arange(self.nocc)[:, None]
+        idx_v = np.arange(self.nvir)[None, :]
+        H[idx_o, idx_v, idx_o, idx_v] = self.epsilon[self.nocc:] - self.epsilon[:self.nocc].reshape(-1, 1)
+        return H
+
     def solve_static_direct(self):
         # Run a quick check to make sure everything will fit into memory
         I_Size = (self.nbf ** 4) * 8.e-9
-        oNNN_Size = (self.nocc * self.nbf ** 3) * 8.e-9
         ovov_Size = (self.nocc * self.nocc * self.nvir * self.nvir) * 8.e-9
         print("\nTensor sizes:")
         print("ERI tensor           %4.2f GB." % I_Size)
-        print("oNNN MO tensor       %4.2f GB." % oNNN_Size)
+        print("ovov+oovv MO tensors %4.2f GB." % (2 * ovov_Size))
         print("ovov Hessian tensor  %4.2f GB." % ovov_Size)
 
         # Estimate memory usage
@@ -98,33 +120,35 @@ class helper_CPHF(object):
         # Compute electronic Hessian
         print('\nForming Hessian...')
         t = time.time()
-        docc = np.diag(np.ones(self.nocc))
-        dvir = np.diag(np.ones(self.nvir))
-        eps_diag = self.epsilon[self.nocc:].reshape(-1, 1) - self.epsilon[:self.nocc]
-
-        # Form oNNN MO tensor, oN^4 cost
-        MO = np.asarray(self.mints.mo_eri(self.Co, self.C, self.C, self.C))
-
-        H = np.einsum('ai,ij,ab->iajb', eps_diag, docc, dvir)
-        H += 4 * MO[:, self.nocc:, :self.nocc, self.nocc:]
-        H -= MO[:, self.nocc:, :self.nocc, self.nocc:].swapaxes(0, 2)
 
+        # Form only the (ia|jb) and (ij|ab) MO blocks the Hessian needs,
+        # both from a single AO ERI evaluation
+        I = self.mints.ao_eri()
+        MO_ovov = np.asarray(self.mints.mo_transform(I, self.Co, self.Cv, self.Co, self.Cv))
+        MO_oovv = np.asarray(self.mints.mo_transform(I, self.Co, self.Co, self.Cv, self.Cv))
 
-        H -= MO[:, :self.nocc, self.nocc:, self.nocc:].swapaxes(1, 2)
+        H = self._orbital_energy_hessian()
+        H += 4 * MO_ovov
+        H -= MO_ovov.swapaxes(0, 2)
+        H -= MO_oovv.swapaxes(1, 2)
 
         print('...formed Hessian in %.3f seconds.' % (time.time() - t))
 
-        # Invert Hessian (o^3 v^3)
-        print('\nInverting Hessian...')
+        # Solve H x = b for all dipole components at once (o^3 v^3)
+        print('\nSolving Hessian equations...')
         t = time.time()
-        Hinv = np.linalg.inv(H.reshape(self.nocc * self.nvir, -1)).reshape(self.nocc, self.nvir, self.nocc, self.nvir)
-        print('...inverted Hessian in %.3f seconds.' % (time.time() - t))
+        nov = self.nocc * self.nvir
+        B = np.stack([self.dipoles_xyz[numx].ravel() for numx in range(3)], axis=1)
+        # H is symmetric, so its transpose is the same matrix in Fortran
+        # order and can be factored in place
+        lu = lu_factor(H.reshape(nov, nov).T, overwrite_a=True)
+        X = lu_solve(lu, B)
+        print('...solved Hessian equations in %.3f seconds.' % (time.time() - t))
 
         # Form perturbation response vector for each dipole component
         self.x = []
         for numx in range(3):
-            xcomp = np.einsum('iajb,ia->jb', Hinv, self.dipoles_xyz[numx])
-            self.x.append(xcomp.reshape(-1))
+            self.x.append(X[:, numx].copy())
 
         self.rhsvecs = []
         for numx in range(3):
@@ -134,9 +158,6 @@ class helper_CPHF(object):
     def solve_dynamic_direct(self, omega=0.0):
         # Adapted completely from TDHF.py
 
-        eps_v = self.epsilon[self.nocc:]
-        eps_o = self.epsilon[:self.nocc]
-
         t = time.time()
         I = self.mints.ao_eri()
         v_ijab = np.asarray(self.mints.mo_transform(I, self.Co, self.Co, self.Cv, self.Cv))
@@ -149,8 +170,7 @@ class helper_CPHF(object):
 
         # Build A and B blocks
         t = time.time()
-        A11  = np.einsum('ab,ij->iajb', np.diag(eps_v), np.diag(np.ones(self.nocc)))
-        A11 -= np.einsum('ij,ab->iajb', np.diag(eps_o), np.diag(np.ones(self.nvir)))
+        A11 = self._orbital_energy_hessian()
         A11 += 2 * v_iajb
         A11 -= v_ijab.swapaxes(1, 2)
         A11 *= 2
@@ -179,20 +199,27 @@ class helper_CPHF(object):
         print('Hessian formation took %.3f seconds\n' % (time.time() - t))
 
         t = time.time()
-        Hinv = np.linalg.inv(Hess - S)
-        print('Hessian inversion took %.3f seconds\n' % (time.time() - t))
+        # Hess - S is symmetric; factor its Fortran-ordered transpose in place
+        lu = lu_factor((Hess - S).T, overwrite_a=True)
+        print('Hessian factorization took %.3f seconds\n' % (time.time() - t))
 
         self.x = []
         self.rhsvecs = []
         for numx in range(3):
             rhsvec = self.dipoles_xyz[numx].reshape(-1)
             rhsvec = np.concatenate((rhsvec, -rhsvec))
-            xcomp = Hinv.dot(rhsvec)
             self.rhsvecs.append(rhsvec)
-            self.x.append(xcomp)
+
+        X = lu_solve(lu, np.stack(self.rhsvecs, axis=1))
+        for numx in range(3):
+            self.x.append(X[:, numx].copy())
 
     def solve_static_iterative(self, maxiter=20, conv=1.e-9, use_diis=True):
 
+        # Drop results from any previous solve; these are only set on convergence
+        self.x = None
+        self.rhsvecs = None
+
         # Init JK object
         jk = psi4.core.JK.build(self.scf_wfn.basisset())
         jk.initialize()
@@ -206,68 +233,161 @@ class helper_CPHF(object):
             jk.C_right_add(mC)
 
         # Build initial guess, previous vectors, diis object, and C_left updates
-        self.x = []
-        x_old = []
-        diis = []
         ia_denom = - self.epsilon[:self.nocc].reshape(-1, 1) + self.epsilon[self.nocc:]
+        dipoles = np.asarray(self.dipoles_xyz)
+        inv_ia_denom = np.reciprocal(ia_denom)
+        X = dipoles * inv_ia_denom
+        X_old = np.zeros_like(X)
+        diis = []
         for xyz in range(3):
-            self.x.append(self.dipoles_xyz[xyz] / ia_denom)
-            x_old.append(np.zeros(ia_denom.shape))
             diis.append(DIIS_helper())
 
         # Convert Co and Cv to numpy arrays
         Co = np.asarray(self.Co)
         Cv = np.asarray(self.Cv)
 
+        # Scratch buffer for 4J - K^T - K of all components
+        G_ao = np.empty((3, self.nbf, self.nbf))
+
         print('\nStarting CPHF iterations:')
         t = time.time()
         for CPHF_ITER in range(1, maxiter + 1):
 
             # Update jk's C_right
             for xyz in range(3):
-                npC_right[xyz][:] = Cv.dot(self.x[xyz].T)
+                npC_right[xyz][:] = Cv.dot(X[xyz].T)
 
             # Compute JK objects
             jk.compute()
 
-            # Update amplitudes
+            # Form 4J - K^T - K for each component in the preallocated buffer
             for xyz in range(3):
-                # Build J and K objects
                 J = np.asarray(jk.J()[xyz])
                 K = np.asarray(jk.K()[xyz])
+                np.multiply(J, 4.0, out=G_ao[xyz])
+                np.subtract(G_ao[xyz], K, out=G_ao[xyz])
+                G_ao[xyz] -= K.T
 
-                # Bulid new guess
-                X = self.dipoles_xyz[xyz].copy()
-                X -= (Co.T).dot(4 * J - K.T - K).dot(Cv)
-                X /= ia_denom
+            # Bulid new guess for all components at once
+            X = dipoles - np.einsum('pi,xpq,qa->xia', Co, G_ao, Cv, optimize=True)
+            X *= inv_ia_denom
 
-                # DIIS for good measure
-                if use_diis:
-                    diis[xyz].add(X, X - x_old[xyz])
-                    X = diis[xyz].extrapolate()
-                self.x[xyz] = X.copy()
+            # DIIS for good measure
+            if use_diis:
+                for xyz in range(3):
+                    diis[xyz].add(X[xyz], X[xyz] - X_old[xyz])
+                    X[xyz] = diis[xyz].extrapolate()
 
             # Check for convergence
-            rms = []
-            for xyz in range(3):
-                rms.append(np.max((self.x[xyz] - x_old[xyz]) ** 2))
-                x_old[xyz] = self.x[xyz]
+            diff = X - X_old
+            rms = (diff * diff).reshape(3, -1).max(axis=1)
+            X_old = X
 
-            avg_RMS = sum(rms) / 3
-            max_RMS = max(rms)
+            avg_RMS = rms.mean()
+            max_RMS = rms.max()
 
             if max_RMS < conv:
                 print('CPHF converged in %d iterations and %.2f seconds.' % (CPHF_ITER, time.time() - t))
+                self.x = []
                 self.rhsvecs = []
                 for numx in range(3):
-                    rhsvec = self.dipoles_xyz[numx].reshape(-1)
-                    self.rhsvecs.append(rhsvec)
-                    self.x[numx] = self.x[numx].reshape(-1)
+                    self.rhsvecs.append(self.dipoles_xyz[numx].reshape(-1))
+                    self.x.append(X[numx].reshape(-1))
                 break
 
             print('CPHF Iteration %3d: Average RMS = %3.8f  Maximum RMS = %3.8f' %
                   (CPHF_ITER, avg_RMS, max_RMS))
 
+    def solve_static_krylov(self, maxiter=20, conv=1.e-9):
+
+        # Drop results from any previous solve; these are only set on convergence
+        self.x = None
+        self.rhsvecs = None
+
+        # Init JK object
+        jk = psi4.core.JK.build(self.scf_wfn.basisset())
+        jk.initialize()
+
+        # Add blank matrices to the jk object and numpy hooks to C_right
+        npC_right = []
+        for xyz in range(3):
+            jk.C_left_add(self.Co)
+            mC = psi4.core.Matrix(self.nbf, self.nocc)
+            npC_right.append(np.asarray(mC))
+            jk.C_right_add(mC)
+
+        # Fortran-ordered copies make Co^T C-contiguous for the repeated
+        # Co^T (4J - K^T - K) Cv products
+        Co = np.asfortranarray(self.Co)
+        Cv = np.asfortranarray(self.Cv)
+
+        ia_denom = - self.epsilon[:self.nocc].reshape(-1, 1) + self.epsilon[self.nocc:]
+        nov = self.nocc * self.nvir
+
+        # Scratch buffer for 4J - K^T - K
+        G_ao = np.empty((self.nbf, self.nbf))
+
+        # The three dipole components share the same Hessian, so solve the
+        # block-diagonal stacked system; every product then needs a single
+        # JK build for all components.
+        def hessian_product(x_stack):
+            X = x_stack.reshape(3, self.nocc, self.nvir)
+            for xyz in range(3):
+                npC_right[xyz][:] = Cv.dot(X[xyz].T)
+            jk.compute()
+
+            HX = ia_denom * X
+            for xyz in range(3):
+                J = np.asarray(jk.J()[xyz])
+                K = np.asarray(jk.K()[xyz])
+                np.multiply(J, 4.0, out=G_ao)
+                np.subtract(G_ao, K, out=G_ao)
+                G_ao -= K.T
+                HX[xyz] += (Co.T).dot(G_ao).dot(Cv)
+            return HX.reshape(-1)
+
+        # Orbital energy differences are the diagonal of the Hessian
+        inv_ia_denom_stack = np.tile(np.reciprocal(ia_denom).reshape(-1), 3)
+        H = LinearOperator((3 * nov, 3 * nov), matvec=hessian_product, dtype=np.float64)
+        M = LinearOperator((3 * nov, 3 * nov), matvec=lambda r: r.reshape(-1) * inv_ia_denom_stack,
+                           dtype=np.float64)
+
+        B = np.concatenate([self.dipoles_xyz[xyz].reshape(-1) for xyz in range(3)])
+        x0 = B * inv_ia_denom_stack
+
+        niter = [0]
+
+        def report(rnorm):
+            niter[0] += 1
+            print('CPHF Iteration %3d: Residual norm = %3.8f' % (niter[0], rnorm))
+
+        print('\nStarting CPHF iterations:')
+        t = time.time()
+        gmres_kwargs = {'rtol' if 'rtol' in _gmres_args else 'tol': conv}
+        if 'atol' in _gmres_args:
+            gmres_kwargs['atol'] = 0.0
+        if 'callback_type' in _gmres_args:
+            gmres_kwargs['callback_type'] = 'pr_norm'
+        # gmres counts maxiter in restart cycles; a single cycle of maxiter
+        # inner iterations limits the solve to maxiter Hessian products (JK
+        # builds), as in solve_static_iterative, plus the explicit residual
+        # evaluations for x0 and the final solution.
+        X, info = gmres(H, B, x0=x0, restart=maxiter, maxiter=1, M=M, callback=report,
+                        **gmres_kwargs)
+        if info < 0:
+            raise Exception("GMRES failed with illegal input (info = %d)" % info)
+        elif info > 0:
+            print('CPHF did not converge in %d iterations.' % niter[0])
+            return
+
+        print('CPHF converged in %d iterations and %.2f seconds.' % (niter[0], time.time() - t))
+        X = X.reshape(3, nov)
+        self.x = []
+        self.rhsvecs = []
+        for numx in range(3):
+            self.x.append(X[numx].copy())
+            self.rhsvecs.append(self.dipoles_xyz[numx].reshape(-1))
+
     def solve_dynamic_iterative(self, omega=0.0, maxiter=20, conv=1.e-9, use_diis=True):
 
         # Init JK object
@@ -298,9 +418,9 @@ class helper_CPHF(object):
             diis_l.append(DIIS_helper())
             diis_r.append(DIIS_helper())
 
-        # Convert Co and Cv to numpy arrays
-        Co = np.asarray(self.Co)
-        Cv = np.asarray(self.Cv)
+        # Convert Co and Cv to Fortran-ordered numpy arrays
+        Co = np.asfortranarray(self.Co)
+        Cv = np.asfortranarray(self.Cv)
 
         print('\nStarting CPHF iterations:')
         t = time.time()
@@ -391,6 +511,15 @@ if __name__ == '__main__':
     print('@test_CPHF running solve_static_iterative')
 
     helper.solve_static_iterative()
+    assert helper.x is not None, 'solve_static_iterative did not converge'
+    helper.form_polarizability()
+    assert np.allclose(polar, helper.polar, rtol=0, atol=1.e-5)
+
+    print('\n')
+    print('@test_CPHF running solve_static_krylov')
+
+    helper.solve_static_krylov()
+    assert helper.x is not None, 'solve_static_krylov did not converge'
     helper.form_polarizability()
     assert np.allclose(polar, helper.polar, rtol=0, atol=1.e-5)
 
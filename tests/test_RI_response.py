@@ -5,6 +5,7 @@ from utils import *
 tdir = 'Response-Theory'
 
 
+@using_scipy
 def test_beta(workspace):
     exe_py(workspace, tdir, 'Self-Consistent-Field/beta')
 
@@ -13,6 +14,7 @@ def test_CPHF(workspace):
     exe_py(workspace, tdir, 'Self-Consistent-Field/CPHF')
 
 
+@using_scipy
 def test_helper_CPHF(workspace):
     exe_py(workspace, tdir, 'Self-Consistent-Field/helper_CPHF')
 